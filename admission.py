@@ -0,0 +1,176 @@
+import asyncio
+import contextvars
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Awaitable, Callable, Dict, Optional
+
+REQUEST_DEADLINE_SECONDS = 30.0
+EMBED_CONCURRENCY = 16
+EMBED_QUEUE = 16
+CHAT_CONCURRENCY = 8
+CHAT_QUEUE = 24
+# requests admitted past the event loop; each holds a worker thread, so this
+# must stay below THREADPOOL_SIZE or excess work queues unbounded in anyio
+MAX_INFLIGHT = CHAT_CONCURRENCY + CHAT_QUEUE
+THREADPOOL_SIZE = MAX_INFLIGHT + 16
+
+_deadline: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar("deadline", default=None)
+
+
+class Overloaded(Exception):
+    """Raised instead of queueing work that can't finish before its deadline."""
+
+    def __init__(self, reason: str, retry_after: int = 1):
+        super().__init__(reason)
+        self.retry_after = retry_after
+
+
+# --------- deadlines ----------
+def deadline_from_now(seconds: float = REQUEST_DEADLINE_SECONDS) -> float:
+    return time.monotonic() + seconds
+
+@contextmanager
+def deadline(at: float):
+    """Run the block under an absolute (time.monotonic) deadline."""
+    token = _deadline.set(at)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+def remaining() -> Optional[float]:
+    """Seconds left for the current request, or None outside of one."""
+    d = _deadline.get()
+    if d is None:
+        return None
+    return d - time.monotonic()
+
+
+# --------- concurrency limiting ----------
+class Limiter:
+    """
+    At most `concurrency` calls run at once; at most `max_queue` wait behind
+    them. Callers are turned away up front when the queue is full or the
+    expected wait already exceeds their remaining deadline, and give up if
+    the deadline passes while queued.
+    """
+
+    def __init__(self, name: str, concurrency: int, max_queue: int):
+        self.name = name
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.active = 0
+        self.waiting = 0
+        self.avg_service = 1.0  # EWMA of seconds per call
+        self._cond = threading.Condition()
+
+    def expected_wait(self) -> float:
+        return (self.waiting + 1) / self.concurrency * self.avg_service
+
+    def retry_after(self) -> int:
+        return max(1, math.ceil(self.expected_wait()))
+
+    def _acquire(self):
+        left = remaining()
+        with self._cond:
+            if self.active < self.concurrency and not self.waiting:
+                self.active += 1
+                return
+            if self.waiting >= self.max_queue:
+                raise Overloaded(f"{self.name} queue full", self.retry_after())
+            if left is not None and self.expected_wait() > left:
+                raise Overloaded(f"{self.name} wait exceeds deadline", self.retry_after())
+
+            self.waiting += 1
+            try:
+                while self.active >= self.concurrency:
+                    left = remaining()
+                    if left is not None and left <= 0:
+                        # we may have consumed a release's notify; pass it on
+                        # so a free slot doesn't sit idle behind a sleeping waiter
+                        if self.active < self.concurrency:
+                            self._cond.notify()
+                        raise Overloaded(f"{self.name} deadline passed in queue", self.retry_after())
+                    self._cond.wait(left)
+                self.active += 1
+            finally:
+                self.waiting -= 1
+
+    def _release(self, elapsed: float):
+        with self._cond:
+            self.active -= 1
+            self.avg_service = 0.8 * self.avg_service + 0.2 * elapsed
+            self._cond.notify()
+
+    @contextmanager
+    def slot(self):
+        self._acquire()
+        t0 = time.monotonic()
+        try:
+            yield
+        finally:
+            self._release(time.monotonic() - t0)
+
+
+embed_limiter = Limiter("embed", EMBED_CONCURRENCY, EMBED_QUEUE)
+chat_limiter = Limiter("chat", CHAT_CONCURRENCY, CHAT_QUEUE)
+
+
+# --------- admission at the event loop ----------
+class Gate:
+    """
+    Non-blocking admission for the event loop: a request either gets one of
+    `limit` slots right away or is rejected, before it ever takes a thread.
+    Only touched from the event loop, so no locking.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.inflight = 0
+
+    def try_enter(self) -> bool:
+        if self.inflight >= self.limit:
+            return False
+        self.inflight += 1
+        return True
+
+    def leave(self):
+        self.inflight -= 1
+
+
+gate = Gate(MAX_INFLIGHT)
+
+
+# --------- request coalescing ----------
+class SingleFlight:
+    """
+    Concurrent calls with the same key share one execution of fn. Followers
+    just await the leader's task, so they hold neither a thread nor a slot.
+    """
+
+    def __init__(self):
+        self._calls: Dict[str, asyncio.Task] = {}
+
+    async def do(self, key: str, fn: Callable[[], Awaitable], at: Optional[float] = None):
+        """Returns (result, shared); shared is True for callers that piggybacked."""
+        task = self._calls.get(key)
+        shared = task is not None
+        if not shared:
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda t: self._finished(key, t))
+
+        timeout = None if at is None else max(0.0, at - time.monotonic())
+        try:
+            # shield: one caller timing out must not cancel the shared call
+            result = await asyncio.wait_for(asyncio.shield(task), timeout)
+        except asyncio.TimeoutError:
+            raise Overloaded("deadline passed waiting for the upstream call")
+        return result, shared
+
+    def _finished(self, key: str, task: asyncio.Task):
+        self._calls.pop(key, None)
+        if not task.cancelled():
+            task.exception()  # mark retrieved even if every caller gave up waiting
@@ -1,13 +1,72 @@
 import os
-from fastapi import FastAPI
+import hashlib
+import json
+import threading
+import time
+from contextlib import asynccontextmanager
+import anyio.to_thread
+from fastapi import FastAPI, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel
 from dotenv import load_dotenv
 
-import rag_answer
+import admission
+
+# rag_answer / sessions (OpenAI client, psycopg pool) are imported lazily:
+# the process binds its port right away and warms up in the background.
 
 load_dotenv()
 
-app = FastAPI(title="IRCC RAG API", version="0.1")
+WARMUP_RETRY_SECONDS = 5
+WARMUP_MAX_RETRY_SECONDS = 60
+
+inflight = admission.SingleFlight()
+warm = threading.Event()
+warm_state = {"error": None, "seconds": None}
+
+def warm_up_loop(stop: threading.Event):
+    delay = WARMUP_RETRY_SECONDS
+    while not stop.is_set():
+        t0 = time.monotonic()
+        try:
+            import rag_answer
+            import sessions  # noqa: F401
+
+            rag_answer.warm_up()
+        except Exception as e:
+            warm_state["error"] = f"{e.__class__.__name__}: {e}"
+            print(f"Warm-up failed, retrying in {delay}s: {warm_state['error']}")
+            stop.wait(delay)
+            delay = min(delay * 2, WARMUP_MAX_RETRY_SECONDS)
+            continue
+        warm_state["error"] = None
+        warm_state["seconds"] = round(time.monotonic() - t0, 2)
+        warm.set()
+        print(f"Warm-up done in {warm_state['seconds']}s")
+        break
+
+    # hold the model API connection open between requests
+    import rag_answer
+    while not stop.wait(rag_answer.KEEPALIVE_PING_SECONDS):
+        try:
+            rag_answer.keep_alive()
+        except Exception as e:
+            print(f"Keep-alive ping failed: {e.__class__.__name__}: {e}")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # sync endpoints and /chat's worker share this pool; keep it above the
+    # admission gate so shed requests never sit in anyio's unbounded queue
+    anyio.to_thread.current_default_thread_limiter().total_tokens = admission.THREADPOOL_SIZE
+    stop = threading.Event()
+    threading.Thread(target=warm_up_loop, args=(stop,), name="warm-up", daemon=True).start()
+    yield
+    stop.set()
+    import rag_answer
+    rag_answer.close_pool()
+
+app = FastAPI(title="IRCC RAG API", version="0.1", lifespan=lifespan)
 from fastapi.middleware.cors import CORSMiddleware
 
 app.add_middleware(
@@ -23,27 +82,38 @@ from typing import Optional, List, Dict
 class ChatRequest(BaseModel):
     question: str
     history: Optional[List[Dict]] = None
+    session_id: Optional[str] = None
 
 from typing import List
 
 class ChatResponse(BaseModel):
     answer: str
     sources: List[str] = []
+    session_id: Optional[str] = None
 
 @app.get("/health")
-def health():
+async def health():
     return {"status": "ok"}
 @app.get("/healthz")
-def healthz():
+async def healthz():
     return {"status": "ok"}
-@app.post("/chat", response_model=ChatResponse)
-def chat(req: ChatRequest):
-    q = req.question.strip()
-    history = req.history or []
-    if not q:
-        return {"answer": "Please ask a question.", "sources": []}
-
-    rows = rag_answer.retrieve(q)
+@app.get("/ready")
+async def ready():
+    # liveness stays on /health(z); this one flips only once the pool, model
+    # API connection and vector index are warm
+    if warm.is_set():
+        return {"status": "ready", "warmup_seconds": warm_state["seconds"]}
+    return JSONResponse(status_code=503, content={"status": "warming", "error": warm_state["error"]})
+def answer_turn(session, q, history, at):
+    with admission.deadline(at):
+        return _answer_turn(session, q, history)
+
+def _answer_turn(session, q, history):
+    import rag_answer
+    import sessions
+
+    standalone, rows, _ = sessions.retrieve_for_turn(session, q, history)
+    anchor = session.anchor()
 
     # Extract source URLs from retrieval rows
     sources = []
@@ -68,10 +138,62 @@ def chat(req: ChatRequest):
     seen = set()
     sources = [s for s in sources if not (s in seen or seen.add(s))]
 
-    answer_text = rag_answer.answer(q, rows)
+    answer_text = rag_answer.answer(standalone, rows, history=history, cache_key=session.id)
+    return answer_text, sources, anchor
+
+async def admitted_turn(session, q, history, at):
+    # non-blocking admission on the event loop, before the request takes a thread
+    if not admission.gate.try_enter():
+        raise admission.Overloaded("too many requests in flight", admission.chat_limiter.retry_after())
+    try:
+        return await run_in_threadpool(answer_turn, session, q, history, at)
+    finally:
+        admission.gate.leave()
+
+def coalesce_key(session, q, history):
+    import rag_answer
+
+    # the answer depends on the session's anchor (reused chunks) as well, so
+    # only sessions anchored on the same query may share a call
+    anchor_query = session.anchor()[0]
+    payload = json.dumps([" ".join(q.lower().split()), rag_answer.recent_history(history), anchor_query])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+@app.post("/chat", response_model=ChatResponse)
+async def chat(req: ChatRequest):
+    import sessions
+
+    at = admission.deadline_from_now()  # the clock starts on arrival
+
+    q = req.question.strip()
+    session = sessions.store.get_or_create(req.session_id)
+    # client-supplied history wins; otherwise fall back to what the session remembers
+    history = req.history if req.history is not None else session.history_snapshot()
+    if not q:
+        return {"answer": "Please ask a question.", "sources": [], "session_id": session.id}
+
+    # identical in-flight questions share one retrieval + generation; the rest
+    # pass a non-blocking gate, then bounded limiters, and overload is shed with a 503
+    try:
+        (answer_text, sources, anchor), shared = await inflight.do(
+            coalesce_key(session, q, history),
+            lambda: admitted_turn(session, q, history, at),
+            at=at,
+        )
+    except admission.Overloaded as e:
+        raise HTTPException(
+            status_code=503,
+            detail="Service is busy, please retry shortly.",
+            headers={"Retry-After": str(e.retry_after)},
+        )
+    if shared and anchor[1] is not None:
+        # followers adopt the leader's retrieval so their next turn can reuse it
+        session.set_anchor(*anchor)
+    session.add_turn(q, answer_text)
 
     return {
         "answer": answer_text,
-        "sources": sources
+        "sources": sources,
+        "session_id": session.id,
     }
 # trigger render redeploy
@@ -0,0 +1,210 @@
+import hashlib
+import re
+from collections import Counter
+from typing import Dict, List, Optional, Set, Tuple
+
+import numpy as np
+from dotenv import load_dotenv
+
+import rag_answer
+
+load_dotenv()
+
+SHINGLE_WORDS = 5
+NUM_PERM = 128
+LSH_BANDS = 16              # 16 bands x 8 rows => candidates from ~0.7 Jaccard
+NEAR_DUP_THRESHOLD = 0.85   # estimated Jaccard at which a chunk counts as redundant
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+
+# a, b < 2**31 keeps a * h + b inside uint64 for 32-bit shingle hashes
+_rng = np.random.RandomState(1)
+_PERM_A = _rng.randint(1, 1 << 31, size=NUM_PERM).astype(np.uint64)
+_PERM_B = _rng.randint(0, 1 << 31, size=NUM_PERM).astype(np.uint64)
+
+
+# --------- MinHash ----------
+def shingles(text: str) -> Set[str]:
+    words = re.findall(r"\w+", text.lower())
+    if len(words) < SHINGLE_WORDS:
+        return {" ".join(words)}
+    return {" ".join(words[i:i + SHINGLE_WORDS]) for i in range(len(words) - SHINGLE_WORDS + 1)}
+
+def minhash(text: str) -> np.ndarray:
+    hashes = np.array(
+        [int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=4).digest(), "little")
+         for s in shingles(text)],
+        dtype=np.uint64,
+    )
+    perm = (np.outer(_PERM_A, hashes) + _PERM_B[:, None]) % np.uint64(_MERSENNE_PRIME)
+    return (perm & np.uint64(_MAX_HASH)).min(axis=1)
+
+def similarity(a: np.ndarray, b: np.ndarray) -> float:
+    return float(np.mean(a == b))
+
+
+# --------- LSH index ----------
+Key = Tuple[int, str]  # (source_id, chunk_hash)
+
+class NearDupIndex:
+    """Banded LSH over MinHash signatures; finds chunks that are near-copies of ones already indexed."""
+
+    def __init__(self, bands=LSH_BANDS, threshold=NEAR_DUP_THRESHOLD):
+        self.bands = bands
+        self.rows = NUM_PERM // bands
+        self.threshold = threshold
+        self.sigs: Dict[Key, np.ndarray] = {}
+        self.buckets: List[Dict[bytes, Set[Key]]] = [{} for _ in range(bands)]
+
+    def __len__(self):
+        return len(self.sigs)
+
+    def _bands(self, sig: np.ndarray):
+        for b in range(self.bands):
+            yield b, sig[b * self.rows:(b + 1) * self.rows].tobytes()
+
+    def add(self, key: Key, sig: np.ndarray):
+        self.sigs[key] = sig
+        for b, band in self._bands(sig):
+            self.buckets[b].setdefault(band, set()).add(key)
+
+    def remove_source(self, source_id: int):
+        stale = [k for k in self.sigs if k[0] == source_id]
+        for key in stale:
+            sig = self.sigs.pop(key)
+            for b, band in self._bands(sig):
+                bucket = self.buckets[b].get(band)
+                if bucket:
+                    bucket.discard(key)
+                    if not bucket:
+                        del self.buckets[b][band]
+
+    def query(self, sig: np.ndarray) -> Optional[Tuple[Key, float]]:
+        candidates: Set[Key] = set()
+        for b, band in self._bands(sig):
+            candidates |= self.buckets[b].get(band, set())
+
+        best = None
+        for key in candidates:
+            sim = similarity(sig, self.sigs[key])
+            if sim >= self.threshold and (best is None or sim > best[1]):
+                best = (key, sim)
+        return best
+
+
+# --------- which copy survives ----------
+# Retrieval drops EXCLUDE_URLS pages and, for IMM1295 questions, everything
+# outside the allow-list. A kept copy living on the wrong page would make the
+# text vanish for exactly those queries, so:
+def is_protected(url: str) -> bool:
+    """Allow-listed sources keep their chunks even when they duplicate others."""
+    u = url.lower()
+    return any(a in u for a in rag_answer.IMM1295_ALLOW)
+
+def can_be_kept_copy(url: str) -> bool:
+    """Excluded pages never act as the surviving copy for anyone else."""
+    return url not in rag_answer.EXCLUDE_URLS
+
+
+def load_index(conn) -> NearDupIndex:
+    index = NearDupIndex()
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT c.source_id, c.chunk_hash, c.content, s.url
+            FROM chunks c
+            JOIN sources s ON s.id = c.source_id
+            ORDER BY c.source_id, c.chunk_index
+            """
+        )
+        for source_id, chunk_hash, content, url in cur:
+            if can_be_kept_copy(url):
+                index.add((int(source_id), chunk_hash), minhash(content))
+    return index
+
+
+# --------- corpus report ----------
+def main():
+    """
+    Report how much of the corpus is near-duplicate boilerplate: chunks
+    skipped at ingest (chunk_links) plus any near-copies still in chunks.
+    """
+    from ingest import get_conn
+
+    conn = get_conn()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT c.source_id, c.chunk_hash, c.section, c.content, s.url
+                FROM chunks c
+                JOIN sources s ON s.id = c.source_id
+                ORDER BY c.source_id, c.chunk_index
+                """
+            )
+            rows = cur.fetchall()
+            cur.execute("SELECT to_regclass('chunk_links') IS NOT NULL")
+            has_links = cur.fetchone()[0]
+            links = []
+            if has_links:
+                cur.execute(
+                    """
+                    SELECT l.section, s.url, d.url
+                    FROM chunk_links l
+                    JOIN sources s ON s.id = l.source_id
+                    LEFT JOIN sources d ON d.id = l.dup_source_id
+                    """
+                )
+                links = cur.fetchall()
+    finally:
+        conn.close()
+
+    sections = Counter()
+    per_url = Counter()
+    kept_copies = Counter()
+
+    # skipped at ingest
+    for section, url, dup_url in links:
+        sections[section] += 1
+        per_url[url] += 1
+        kept_copies[dup_url or "(missing source)"] += 1
+
+    # near-copies that made it into chunks anyway (protected sources, or
+    # ingested before dedup existed)
+    index = NearDupIndex()
+    urls = {}
+    in_chunks = 0
+    for source_id, chunk_hash, section, content, url in rows:
+        urls[int(source_id)] = url
+        sig = minhash(content)
+        hit = index.query(sig)
+        if hit:
+            in_chunks += 1
+            sections[section] += 1
+            per_url[url] += 1
+            kept_copies[urls[hit[0][0]]] += 1
+            continue
+        index.add((int(source_id), chunk_hash), sig)
+
+    total = len(rows) + len(links)
+    redundant = len(links) + in_chunks
+    pct = 100.0 * redundant / total if total else 0.0
+    print(
+        f"Chunks prepared: {total} | Near-duplicates: {redundant} ({pct:.1f}%) "
+        f"| Skipped at ingest: {len(links)} | Still in chunks: {in_chunks} | Unique: {len(index)}"
+    )
+
+    if sections:
+        print("\n--- Most repeated sections ---")
+        for section, n in sections.most_common(10):
+            print(f"{n:5d}  {section}")
+        print("\n--- Sources with the most redundant chunks ---")
+        for url, n in per_url.most_common(10):
+            print(f"{n:5d}  {url}")
+        print("\n--- Sources holding the kept copy ---")
+        for url, n in kept_copies.most_common(10):
+            print(f"{n:5d}  {url}")
+
+if __name__ == "__main__":
+    main()
@@ -15,6 +15,8 @@ from dotenv import load_dotenv
 from pypdf import PdfReader
 import io
 
+import dedupe
+
 # Load .env (OPENAI_API_KEY, DATABASE_URL)
 load_dotenv()
 
@@ -224,6 +226,123 @@ def insert_chunks(conn, source_id: int, chunks: List[Chunk]) -> int:
         conn.commit()
     return inserted
 
+def ensure_schema(conn):
+    # near-duplicate chunks we skipped, kept (unembedded) so they can be
+    # restored if the copy they point at goes away
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS chunk_links (
+                source_id integer NOT NULL REFERENCES sources(id) ON DELETE CASCADE,
+                chunk_hash text NOT NULL,
+                chunk_index integer NOT NULL,
+                section text,
+                content text NOT NULL,
+                dup_source_id integer NOT NULL,
+                dup_chunk_hash text NOT NULL,
+                PRIMARY KEY (source_id, chunk_hash)
+            )
+            """
+        )
+        cur.execute("CREATE INDEX IF NOT EXISTS chunk_links_dup_source ON chunk_links (dup_source_id)")
+    conn.commit()
+
+def drop_near_duplicates(index: "dedupe.NearDupIndex", source_id: int, url: str, chunks: List[Chunk]):
+    """
+    Split chunks into (kept, duplicates). A chunk is a duplicate when it is a
+    near-copy of one already indexed anywhere in the corpus (shared navigation,
+    "Report a problem", repeated eligibility text). Kept chunks are added to
+    the index so later sources dedupe against them too.
+    duplicates is a list of (chunk, (matched_source_id, matched_chunk_hash)).
+    """
+    protected = dedupe.is_protected(url)
+    indexable = dedupe.can_be_kept_copy(url)
+    kept, duplicates = [], []
+    for c in chunks:
+        sig = dedupe.minhash(c.content)
+        hit = None if protected else index.query(sig)
+        if hit:
+            duplicates.append((c, hit[0]))
+            continue
+        if indexable:
+            index.add((source_id, c.chunk_hash), sig)
+        kept.append(c)
+    return kept, duplicates
+
+def insert_links(conn, source_id: int, duplicates) -> None:
+    with conn.cursor() as cur:
+        cur.executemany(
+            """
+            INSERT INTO chunk_links (source_id, chunk_hash, chunk_index, section, content, dup_source_id, dup_chunk_hash)
+            VALUES (%s,%s,%s,%s,%s,%s,%s)
+            ON CONFLICT (source_id, chunk_hash)
+            DO UPDATE SET dup_source_id = EXCLUDED.dup_source_id, dup_chunk_hash = EXCLUDED.dup_chunk_hash
+            """,
+            [
+                (source_id, c.chunk_hash, c.chunk_index, c.section, c.content, dup_sid, dup_hash)
+                for c, (dup_sid, dup_hash) in duplicates
+            ],
+        )
+    conn.commit()
+
+def relink_dependents(conn, index: "dedupe.NearDupIndex", source_id: int) -> int:
+    """
+    Re-check chunks other sources skipped as copies of source_id, whose
+    chunks were just replaced. Still-duplicated ones are pointed at their new
+    match; the rest are embedded and restored under their own source.
+    Returns how many were restored.
+    """
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT l.source_id, s.url, l.chunk_hash, l.chunk_index, l.section, l.content
+            FROM chunk_links l
+            JOIN sources s ON s.id = l.source_id
+            WHERE l.dup_source_id = %s AND l.source_id <> %s
+            """,
+            (source_id, source_id),
+        )
+        dependents = cur.fetchall()
+
+    restored = 0
+    for dep_source_id, dep_url, chunk_hash, chunk_index, section, content in dependents:
+        c = Chunk(section=section, content=content, chunk_index=chunk_index, chunk_hash=chunk_hash)
+        sig = dedupe.minhash(content)
+        hit = index.query(sig)
+        if hit:
+            insert_links(conn, dep_source_id, [(c, hit[0])])
+            continue
+
+        insert_chunks(conn, dep_source_id, [c])
+        if dedupe.can_be_kept_copy(dep_url):
+            index.add((dep_source_id, chunk_hash), sig)
+        with conn.cursor() as cur:
+            cur.execute(
+                "DELETE FROM chunk_links WHERE source_id=%s AND chunk_hash=%s",
+                (dep_source_id, chunk_hash),
+            )
+        conn.commit()
+        restored += 1
+    return restored
+
+def store_chunks(conn, index: "dedupe.NearDupIndex", source_id: int, url: str, chunks: List[Chunk]):
+    """
+    Replace a changed source's chunks: skip and link near-duplicates, embed
+    the rest, then fix up chunks elsewhere that were linked to the old ones.
+    Returns (inserted, duplicates, restored).
+    """
+    # old chunks and links were just invalidated; don't let them shadow the new ones
+    with conn.cursor() as cur:
+        cur.execute("DELETE FROM chunk_links WHERE source_id=%s", (source_id,))
+    conn.commit()
+    index.remove_source(source_id)
+
+    kept, dups = drop_near_duplicates(index, source_id, url, chunks)
+    inserted = insert_chunks(conn, source_id, kept)
+    insert_links(conn, source_id, dups)
+    restored = relink_dependents(conn, index, source_id)
+    return inserted, dups, restored
+
 # --------- run ----------
 def load_urls(path="sources.txt") -> List[str]:
     urls = []
@@ -241,6 +360,12 @@ def main():
 
     conn = get_conn()
     try:
+        ensure_schema(conn)
+        index = dedupe.load_index(conn)
+        print(f"Near-duplicate index: {len(index)} existing chunks")
+
+        prepared = skipped = 0
+        linked_to = {}
         for url in urls:
             print(f"\n--- Ingesting: {url}")
             doc = extract_document(url)
@@ -253,8 +378,21 @@ def main():
                 print("No change detected (hash match). Skipping.")
                 continue
 
-            n = insert_chunks(conn, source_id, chunks)
-            print(f"Prepared chunks: {len(chunks)} | Inserted: {n}")
+            n, dups, restored = store_chunks(conn, index, source_id, url, chunks)
+            for _, (dup_source_id, _) in dups:
+                linked_to[dup_source_id] = linked_to.get(dup_source_id, 0) + 1
+            prepared += len(chunks)
+            skipped += len(dups)
+
+            print(
+                f"Prepared chunks: {len(chunks)} | Near-duplicates linked: {len(dups)} "
+                f"| Inserted: {n} | Restored elsewhere: {restored}"
+            )
+
+        if prepared:
+            print(f"\nRedundancy: {skipped}/{prepared} chunks ({100.0 * skipped / prepared:.1f}%) were near-duplicates")
+            for dup_source_id, n in sorted(linked_to.items(), key=lambda kv: -kv[1])[:5]:
+                print(f"  {n:4d} duplicate(s) of source {dup_source_id}")
     finally:
         conn.close()
 
@@ -1,35 +1,184 @@
+import math
 import os
-from openai import OpenAI
+import threading
+from contextlib import contextmanager
 import psycopg
+from psycopg_pool import ConnectionPool
 from pgvector.psycopg import register_vector
 from pgvector import Vector
 from dotenv import load_dotenv
 
+import admission
+
 load_dotenv()
 
 EMBED_MODEL = "text-embedding-3-small"
 TOP_K_FETCH = 25
 TOP_K_USE = 6  # how many chunks we pass into the model
+CHAT_MODEL = "gpt-4.1-mini"
+HISTORY_MESSAGES = 6  # how many prior turns (user + assistant) we send along
 
 EXCLUDE_URLS = {
     "https://www.canada.ca/en/immigration-refugees-citizenship/services/application/application-forms-guides.html"
 }
 
-client = OpenAI()
+# Hard allow-list for IMM1295 questions (URL substrings)
+IMM1295_ALLOW = [
+    "guide-5487",
+    "imm1295",
+    "imm5488",  # checklist
+    "imm5707",
+    "imm5409",
+    "imm5476",
+    "imm5475",
+]
+
+POOL_MIN_SIZE = 2
+POOL_MAX_SIZE = 10
+WARMUP_QUERY = "How do I apply for a study permit?"
+# httpx drops idle connections after 5s by default, which would throw away
+# the TLS session warm-up just paid for; keep them much longer and ping
+# the model API while idle so the first real request reuses one.
+KEEPALIVE_EXPIRY_SECONDS = 300
+KEEPALIVE_PING_SECONDS = 60
+
+_client = None
+_pool = None
+_init_lock = threading.Lock()
+
+def get_client():
+    # built on first use so importing this module stays cheap
+    global _client
+    if _client is None:
+        with _init_lock:
+            if _client is None:
+                import httpx
+                from openai import DefaultHttpxClient, OpenAI
+                _client = OpenAI(
+                    http_client=DefaultHttpxClient(
+                        limits=httpx.Limits(
+                            max_connections=100,
+                            max_keepalive_connections=20,
+                            keepalive_expiry=KEEPALIVE_EXPIRY_SECONDS,
+                        ),
+                    ),
+                )
+    return _client
+
+def get_pool() -> ConnectionPool:
+    global _pool
+    if _pool is None:
+        with _init_lock:
+            if _pool is None:
+                _pool = ConnectionPool(
+                    os.environ["DATABASE_URL"],
+                    min_size=POOL_MIN_SIZE,
+                    max_size=POOL_MAX_SIZE,
+                    kwargs={"autocommit": True},
+                    configure=register_vector,
+                    open=True,  # connects in the background
+                )
+    return _pool
+
+def open_pool(timeout: float = 30.0):
+    # block until min_size connections are established
+    pool = get_pool()
+    pool.wait(timeout=timeout)
+    return pool
+
+def close_pool():
+    if _pool is not None:
+        _pool.close()
+
+def prewarm_index(conn):
+    """
+    Load the chunks table and its indexes (incl. the vector index) into
+    shared buffers. Only runs if the pg_prewarm extension is already
+    installed (that's for ops/ingest to do, not the serving role); returns
+    False otherwise so callers can rely on the warm-up query instead.
+    """
+    with conn.cursor() as cur:
+        cur.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_prewarm'")
+        if cur.fetchone() is None:
+            print("pg_prewarm not installed; relying on warm-up query")
+            return False
+        try:
+            cur.execute(
+                """
+                SELECT pg_prewarm(oid)
+                FROM pg_class
+                WHERE oid = 'chunks'::regclass
+                   OR oid IN (SELECT indexrelid FROM pg_index WHERE indrelid = 'chunks'::regclass)
+                """
+            )
+        except psycopg.Error as e:
+            print(f"pg_prewarm failed ({e.__class__.__name__}); relying on warm-up query")
+            return False
+    return True
+
+def warm_up():
+    """
+    Open the DB pool, prewarm the embedding index and establish the HTTP
+    keep-alive to the model API, so the first real request doesn't pay for it.
+    """
+    pool = open_pool()
+    with pool.connection() as conn:
+        prewarm_index(conn)
+    # one real embedding + search: TLS to OpenAI and the ANN path in Postgres
+    retrieve(WARMUP_QUERY)
+
+def keep_alive():
+    # cheap authenticated GET over the pooled connection, so it never idles out
+    get_client().models.retrieve(EMBED_MODEL)
+
+@contextmanager
+def upstream(limiter):
+    """
+    A slot on `limiter` plus a client bound to the request's remaining time.
+    Under a deadline the SDK doesn't retry (each retry would get the full
+    timeout again), and timeouts, connection errors and rate limits come
+    out as admission.Overloaded so /chat sheds them with a 503.
+    """
+    import openai
 
-def get_conn():
-    conn = psycopg.connect(os.environ["DATABASE_URL"])
-    register_vector(conn)
-    return conn
+    with limiter.slot():
+        left = admission.remaining()
+        if left is None:
+            client = get_client()
+        elif left <= 0:
+            raise admission.Overloaded("deadline passed", limiter.retry_after())
+        else:
+            client = get_client().with_options(timeout=left, max_retries=0)
+
+        try:
+            yield client
+        except openai.RateLimitError as e:
+            try:
+                retry_after = max(1, math.ceil(float(e.response.headers.get("retry-after"))))
+            except (TypeError, ValueError):
+                retry_after = limiter.retry_after()
+            raise admission.Overloaded("model API rate limited", retry_after) from e
+        except (openai.APITimeoutError, openai.APIConnectionError) as e:
+            raise admission.Overloaded(f"model API unavailable ({e.__class__.__name__})", limiter.retry_after()) from e
 
 def embed_query(text: str):
-    resp = client.embeddings.create(model=EMBED_MODEL, input=text)
+    with upstream(admission.embed_limiter) as client:
+        resp = client.embeddings.create(model=EMBED_MODEL, input=text)
     return resp.data[0].embedding
 
+def cosine(a, b) -> float:
+    dot = sum(x * y for x, y in zip(a, b))
+    na = sum(x * x for x in a) ** 0.5
+    nb = sum(y * y for y in b) ** 0.5
+    if not na or not nb:
+        return 0.0
+    return dot / (na * nb)
+
 def retrieve(query: str):
-    qvec = embed_query(query)
-    conn = get_conn()
-    with conn.cursor() as cur:
+    return search(query, embed_query(query))
+
+def search(query: str, qvec):
+    with get_pool().connection() as conn, conn.cursor() as cur:
         cur.execute(
             """
             SELECT s.url, c.section, c.content
@@ -41,23 +190,13 @@ def retrieve(query: str):
             (Vector(qvec), TOP_K_FETCH),
         )
         rows = cur.fetchall()
-    conn.close()
 
     # filter noisy index pages
     rows = [r for r in rows if r[0] not in EXCLUDE_URLS]
         # Hard allow-list for IMM1295 questions (prevents unrelated programs from leaking in)
     q = query.lower()
     if "imm1295" in q or "imm 1295" in q:
-        allow = [
-            "guide-5487",
-            "imm1295",
-            "imm5488",  # checklist
-            "imm5707",
-            "imm5409",
-            "imm5476",
-            "imm5475",
-        ]
-        rows = [r for r in rows if any(a in r[0].lower() for a in allow)]
+        rows = [r for r in rows if any(a in r[0].lower() for a in IMM1295_ALLOW)]
 
         # Safety fallback: if filtering becomes too strict, keep the best guide source
         if not rows:
@@ -74,21 +213,49 @@ def build_context(rows):
         parts.append(f"[{i}] URL: {url}\nSection: {section}\nText: {content}")
     return "\n\n".join(parts)
 
-def answer(query: str, rows):
-    context = build_context(rows)
+def recent_history(history):
+    # keep only well-formed user/assistant turns, newest last
+    turns = []
+    for h in history or []:
+        if not isinstance(h, dict):
+            continue
+        role = h.get("role")
+        content = h.get("content")
+        if role in ("user", "assistant") and isinstance(content, str) and content.strip():
+            turns.append({"role": role, "content": content.strip()})
+    return turns[-HISTORY_MESSAGES:]
 
-    system = (
-        "You are an immigration information assistant. "
-        "Use ONLY the provided sources. "
-        "If the sources do not support an answer, say so."
-    )
+def condense_question(query: str, history) -> str:
+    """
+    Rewrite a follow-up ("and what about the fee?") into a standalone
+    question using the conversation so far. Returns the query unchanged
+    when there is no history to lean on.
+    """
+    turns = recent_history(history)
+    if not turns:
+        return query
 
-    user = f"""
-Question:
-{query}
+    transcript = "\n".join(f"{t['role']}: {t['content']}" for t in turns)
+    with upstream(admission.chat_limiter) as client:
+        resp = client.responses.create(
+            model=CHAT_MODEL,
+            input=[
+                {
+                    "role": "system",
+                    "content": (
+                        "Rewrite the user's latest message as a standalone question "
+                        "about Canadian immigration, using the conversation for context. "
+                        "Reply with the question only."
+                    ),
+                },
+                {"role": "user", "content": f"Conversation:\n{transcript}\n\nLatest message:\n{query}"},
+            ],
+        )
+    return resp.output_text.strip() or query
 
-Sources:
-{context}
+SYSTEM_PROMPT = """You are an immigration information assistant.
+Use ONLY the provided sources.
+If the sources do not support an answer, say so.
 
 Instructions:
 - Answer in plain language.
@@ -97,13 +264,29 @@ Instructions:
 - DO NOT list or mention sources in the answer.
 """
 
-    resp = client.responses.create(
-        model="gpt-4.1-mini",
-        input=[
-            {"role": "system", "content": system},
-            {"role": "user", "content": user},
-        ],
-    )
+def answer(query: str, rows, history=None, cache_key=None):
+    context = build_context(rows)
+
+    # Stable prefix first (system + sources), then the conversation, then the
+    # question. Follow-ups that reuse the same sources share the whole prefix,
+    # which lets the provider serve it from its prompt cache.
+    messages = [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": f"Sources:\n{context}"},
+    ]
+    messages.extend(recent_history(history))
+    messages.append({"role": "user", "content": f"Question:\n{query}"})
+
+    kwargs = {}
+    if cache_key:
+        kwargs["prompt_cache_key"] = cache_key
+
+    with upstream(admission.chat_limiter) as client:
+        resp = client.responses.create(
+            model=CHAT_MODEL,
+            input=messages,
+            **kwargs,
+        )
     return resp.output_text
 
 def main():
@@ -115,6 +298,7 @@ def main():
 
     print("\n--- Answer ---\n")
     print(answer(query, rows))
+    close_pool()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,343 @@
+import argparse
+import heapq
+import math
+import statistics
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+
+import psycopg
+from dotenv import load_dotenv
+
+import dedupe
+import ingest
+
+load_dotenv()
+
+MIN_INTERVAL = timedelta(hours=1)
+MAX_INTERVAL = timedelta(days=30)
+DEFAULT_INTERVAL = timedelta(days=1)      # sources we have no history for yet
+ERROR_RETRY = timedelta(hours=2)
+TARGET_CHANGE_PROB = 0.5                  # recheck once a change is this likely
+HISTORY_DAYS = 180
+FETCHES_PER_MINUTE = 6                    # be polite to canada.ca
+FETCH_BURST = 3
+STATS_EVERY_SECONDS = 15 * 60
+RECONNECT_SECONDS = 30
+
+
+# --------- schema ----------
+def ensure_schema(conn):
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS source_checks (
+                id bigserial PRIMARY KEY,
+                source_id integer NOT NULL REFERENCES sources(id) ON DELETE CASCADE,
+                checked_at timestamptz NOT NULL DEFAULT now(),
+                changed boolean NOT NULL,
+                error text
+            )
+            """
+        )
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS source_checks_source_time ON source_checks (source_id, checked_at)"
+        )
+    conn.commit()
+
+def record_check(conn, source_id: int, changed: bool, error: Optional[str] = None):
+    with conn.cursor() as cur:
+        cur.execute(
+            "INSERT INTO source_checks (source_id, changed, error) VALUES (%s,%s,%s)",
+            (source_id, changed, error),
+        )
+    conn.commit()
+
+
+# --------- change-rate model ----------
+@dataclass
+class SourceState:
+    url: str
+    source_id: Optional[int] = None
+    last_checked: Optional[datetime] = None
+    last_ok: Optional[datetime] = None    # last successful check
+    checks: int = 0            # successful checks in the history window
+    changes: int = 0           # ...that found a change since the previous one
+    span: timedelta = timedelta(0)
+    errors: int = 0
+    interval: timedelta = DEFAULT_INTERVAL
+    dirty: bool = False        # source row updated but its chunks not fully stored
+
+    @property
+    def change_rate(self) -> float:
+        """
+        Estimated changes per day. Uses the Cho & Garcia-Molina estimator for
+        periodic checks, which doesn't assume we saw every change between them.
+        """
+        if self.checks < 2 or self.span <= timedelta(0):
+            return 0.0
+        avg_days = self.span.total_seconds() / 86400 / (self.checks - 1)
+        n, x = self.checks - 1, min(self.changes, self.checks - 1)
+        return -math.log((n - x + 0.5) / (n + 0.5)) / avg_days
+
+    def next_interval(self) -> timedelta:
+        rate = self.change_rate
+        if self.checks < 2:
+            interval = DEFAULT_INTERVAL
+        elif rate <= 0:
+            # never seen it change: back off with the quiet period
+            interval = max(DEFAULT_INTERVAL, self.span)
+        else:
+            interval = timedelta(days=-math.log(1 - TARGET_CHANGE_PROB) / rate)
+        return max(MIN_INTERVAL, min(MAX_INTERVAL, interval))
+
+    def due_at(self) -> datetime:
+        if self.last_checked is None:
+            return datetime.min.replace(tzinfo=timezone.utc)
+        return self.last_checked + self.interval
+
+def load_states(conn, urls: List[str]) -> Dict[str, SourceState]:
+    states = {u: SourceState(url=u) for u in urls}
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            WITH k AS (
+                SELECT id, source_id, checked_at, changed, error,
+                       lag(checked_at) OVER (
+                           PARTITION BY source_id, (error IS NULL) ORDER BY checked_at
+                       ) AS prev_checked_at
+                FROM source_checks
+                WHERE checked_at > now() - make_interval(days => %s)
+            )
+            SELECT s.url, s.id, s.retrieved_at,
+                   count(k.id) FILTER (WHERE k.error IS NULL),
+                   -- a change only counts against an interval we observed: the
+                   -- first check in the window (incl. the initial insert) has none
+                   count(k.id) FILTER (WHERE k.error IS NULL AND k.changed AND k.prev_checked_at IS NOT NULL),
+                   count(k.id) FILTER (WHERE k.error IS NOT NULL),
+                   min(k.checked_at) FILTER (WHERE k.error IS NULL),
+                   max(k.checked_at) FILTER (WHERE k.error IS NULL),
+                   max(k.checked_at),
+                   (array_agg(k.error IS NOT NULL ORDER BY k.checked_at DESC))[1]
+            FROM sources s
+            LEFT JOIN k ON k.source_id = s.id
+            WHERE s.url = ANY(%s)
+            GROUP BY s.id
+            """,
+            (HISTORY_DAYS, urls),
+        )
+        for url, source_id, retrieved_at, checks, changes, errors, first_ok, last_ok, last, last_failed in cur.fetchall():
+            st = states[url]
+            st.source_id = int(source_id)
+            st.checks, st.changes, st.errors = checks, changes, errors
+            st.last_checked = last or retrieved_at
+            st.last_ok = last_ok
+            st.span = (last_ok - first_ok) if (first_ok and last_ok) else timedelta(0)
+            st.interval = st.next_interval()
+            if last_failed:
+                # same as record_failure: retry soon rather than a full interval later
+                st.interval = min(st.interval, ERROR_RETRY)
+    return states
+
+
+# --------- rate limiting ----------
+class TokenBucket:
+    def __init__(self, per_minute: float, burst: int):
+        self.rate = per_minute / 60.0
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def take(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            time.sleep((1 - self.tokens) / self.rate)
+
+
+# --------- refresh ----------
+@dataclass
+class RunStats:
+    checked: int = 0
+    changed: int = 0
+    errors: int = 0
+    inserted: int = 0
+    near_dups: int = 0
+    started: float = field(default_factory=time.monotonic)
+
+def refresh_one(conn, index: "dedupe.NearDupIndex", st: SourceState, stats: RunStats):
+    doc = ingest.extract_document(st.url)
+    chunks = ingest.chunk_sections(doc.sections)
+    source_id, changed = ingest.upsert_source(conn, doc, doc_type="IRCC", program=None)
+    conn.commit()
+    st.source_id = source_id
+
+    if changed:
+        st.dirty = True
+        n, dups, restored = ingest.store_chunks(conn, index, source_id, st.url, chunks)
+        st.dirty = False
+        stats.changed += 1
+        stats.inserted += n + restored
+        stats.near_dups += len(dups)
+        print(
+            f"[changed] {st.url} | chunks: {len(chunks)} | near-dups: {len(dups)} "
+            f"| inserted: {n} | restored: {restored}"
+        )
+
+    record_check(conn, source_id, changed)
+    stats.checked += 1
+
+    now = datetime.now(timezone.utc)
+    if st.checks == 0:
+        # first observation: nothing to compare against, so no change counted
+        st.span = timedelta(0)
+    else:
+        st.span += now - st.last_ok
+        st.changes += int(changed)
+    st.checks += 1
+    st.last_checked = st.last_ok = now
+    st.interval = st.next_interval()
+
+def usable_conn(conn):
+    """Roll back a failed transaction, reconnecting (with retries) if the connection is gone."""
+    if not conn.closed and not conn.broken:
+        try:
+            conn.rollback()
+            return conn
+        except psycopg.Error:
+            pass
+    try:
+        conn.close()
+    except psycopg.Error:
+        pass
+    while True:
+        try:
+            return ingest.get_conn()
+        except psycopg.OperationalError as e:
+            print(f"[db] reconnect failed, retrying in {RECONNECT_SECONDS}s: {e}")
+            time.sleep(RECONNECT_SECONDS)
+
+def record_failure(conn, index: "dedupe.NearDupIndex", st: SourceState, stats: RunStats, err: Exception):
+    """Log a failed refresh, returning a usable connection."""
+    stats.errors += 1
+    st.errors += 1
+    error = f"{err.__class__.__name__}: {err}"
+    print(f"[error] {st.url}: {error}")
+
+    conn = usable_conn(conn)
+    try:
+        if st.dirty:
+            # chunks only partly replaced: forget the new hash so the next
+            # check re-ingests the page instead of seeing a hash match
+            index.remove_source(st.source_id)
+            with conn.cursor() as cur:
+                cur.execute("UPDATE sources SET content_hash='' WHERE id=%s", (st.source_id,))
+            conn.commit()
+            st.dirty = False
+        if st.source_id is not None:
+            record_check(conn, st.source_id, False, error)
+    except psycopg.Error as e:
+        print(f"[error] could not record failure for {st.url}: {e}")
+        conn = usable_conn(conn)
+
+    st.last_checked = datetime.now(timezone.utc)
+    st.interval = min(st.next_interval(), ERROR_RETRY)
+    return conn
+
+def print_stats(states: Dict[str, SourceState], stats: RunStats):
+    now = datetime.now(timezone.utc)
+    ages = [(now - s.last_checked) for s in states.values() if s.last_checked]
+    overdue = sum(1 for s in states.values() if s.due_at() <= now)
+    intervals = [s.interval.total_seconds() / 3600 for s in states.values()]
+
+    print("\n--- Freshness ---")
+    print(f"Sources: {len(states)} | Never fetched: {len(states) - len(ages)} | Overdue: {overdue}")
+    if ages:
+        hours = [a.total_seconds() / 3600 for a in ages]
+        print(f"Age since last check (h): median {statistics.median(hours):.1f} | max {max(hours):.1f}")
+    if intervals:
+        print(f"Recheck interval (h): median {statistics.median(intervals):.1f} | min {min(intervals):.1f} | max {max(intervals):.1f}")
+    print(
+        f"This run: checked {stats.checked} | changed {stats.changed} | errors {stats.errors} "
+        f"| inserted {stats.inserted} | near-dups skipped {stats.near_dups} "
+        f"| uptime {(time.monotonic() - stats.started) / 3600:.1f}h"
+    )
+    fastest = sorted(states.values(), key=lambda s: -s.change_rate)[:5]
+    fastest = [s for s in fastest if s.change_rate > 0]
+    if fastest:
+        print("Fastest-changing:")
+        for s in fastest:
+            print(f"  {s.change_rate:6.2f}/day  every {s.interval.total_seconds() / 3600:6.1f}h  {s.url}")
+
+def run(once: bool = False):
+    urls = ingest.load_urls()
+    if not urls:
+        raise RuntimeError("sources.txt is empty")
+
+    conn = ingest.get_conn()
+    try:
+        ensure_schema(conn)
+        ingest.ensure_schema(conn)
+        states = load_states(conn, urls)
+        index = dedupe.load_index(conn)
+        conn.commit()  # don't sit idle in the loading transaction between refreshes
+        bucket = TokenBucket(FETCHES_PER_MINUTE, FETCH_BURST)
+        stats = RunStats()
+
+        # (due_at, -change_rate, url): most overdue first, faster-changing breaks ties
+        queue = [(s.due_at(), -s.change_rate, s.url) for s in states.values()]
+        heapq.heapify(queue)
+        print_stats(states, stats)
+        last_stats = time.monotonic()
+
+        while queue:
+            due, _, url = queue[0]
+            now = datetime.now(timezone.utc)
+            if due > now:
+                if once:
+                    break
+                time.sleep(min((due - now).total_seconds(), STATS_EVERY_SECONDS))
+            else:
+                heapq.heappop(queue)
+                bucket.take()
+                st = states[url]
+                try:
+                    refresh_one(conn, index, st, stats)
+                except Exception as e:
+                    conn = record_failure(conn, index, st, stats, e)
+                heapq.heappush(queue, (st.due_at(), -st.change_rate, url))
+
+            if time.monotonic() - last_stats >= STATS_EVERY_SECONDS:
+                print_stats(states, stats)
+                last_stats = time.monotonic()
+
+        print_stats(states, stats)
+    finally:
+        conn.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Adaptive refresh of the source corpus")
+    parser.add_argument("--once", action="store_true", help="refresh everything currently due, then exit")
+    parser.add_argument("--stats", action="store_true", help="print freshness stats and exit")
+    args = parser.parse_args()
+
+    if args.stats:
+        conn = ingest.get_conn()
+        try:
+            ensure_schema(conn)
+            states = load_states(conn, ingest.load_urls())
+            conn.commit()
+            print_stats(states, RunStats())
+        finally:
+            conn.close()
+        return
+
+    run(once=args.once)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+import rag_answer
+
+SESSION_TTL_SECONDS = 30 * 60
+MAX_SESSIONS = 1000
+MAX_HISTORY = 20           # messages we keep per session
+# cosine of the follow-up's own embedding to the anchor above which we reuse
+# its chunks. text-embedding-3-small scores run low (related immigration
+# questions commonly land around 0.4-0.6), so this is set for that model.
+REUSE_SIMILARITY = 0.60
+ANCHOR_DRIFT = 0.3         # how far each reused turn pulls the anchor toward itself
+
+# A follow-up naming a form or program the anchor didn't is a new topic,
+# however close the embeddings are ("study permit" -> "work permit for my spouse").
+TOPIC_TERMS = re.compile(
+    r"\bimm\s?\d{4}\w*|guide\s?\d{4}|"
+    r"study permit|work permit|pgwp|post-graduation|visitor visa|super visa|"
+    r"\beta\b|transit|permanent resid\w*|\bpr card|express entry|citizenship|refugee|asylum|"
+    r"spous\w*|partner|common-law|child\w*|dependant\w*|parents?|grandparents?|sponsor\w*|"
+    r"caregiver|provincial nominee|\bpnp\b|biometrics|medical exam\w*"
+)
+
+
+# --------- session state ----------
+@dataclass
+class Session:
+    id: str
+    history: List[Dict] = field(default_factory=list)
+    anchor_query: Optional[str] = None    # standalone query that last hit the DB
+    anchor_qvec: Optional[List[float]] = None
+    rows: list = field(default_factory=list)
+    touched_at: float = field(default_factory=time.monotonic)
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def add_turn(self, question: str, answer: str):
+        with self.lock:
+            self.history = (self.history + [
+                {"role": "user", "content": question},
+                {"role": "assistant", "content": answer},
+            ])[-MAX_HISTORY:]
+
+    def history_snapshot(self) -> List[Dict]:
+        with self.lock:
+            return list(self.history)
+
+    def anchor(self):
+        with self.lock:
+            return self.anchor_query, self.anchor_qvec, self.rows
+
+    def set_anchor(self, query: str, qvec, rows):
+        with self.lock:
+            self.anchor_query, self.anchor_qvec, self.rows = query, qvec, rows
+
+
+class SessionStore:
+    """In-process LRU of chat sessions, expired after SESSION_TTL_SECONDS idle."""
+
+    def __init__(self, ttl=SESSION_TTL_SECONDS, max_sessions=MAX_SESSIONS):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self._sessions: "OrderedDict[str, Session]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_create(self, session_id: Optional[str]) -> Session:
+        """
+        Returns the live session for session_id, or a fresh one under a newly
+        minted id. Client-chosen ids are never adopted, so a guessable id like
+        "1" can't become a session shared between callers.
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            s = self._sessions.get(session_id) if session_id else None
+            if s is None:
+                s = Session(id=uuid.uuid4().hex)
+                self._sessions[s.id] = s
+                while len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+            self._sessions.move_to_end(s.id)
+            s.touched_at = now
+            return s
+
+    def _expire(self, now: float):
+        while self._sessions:
+            sid, s = next(iter(self._sessions.items()))
+            if now - s.touched_at < self.ttl:
+                break
+            del self._sessions[sid]
+
+
+store = SessionStore()
+
+
+# --------- retrieval ----------
+def topic_terms(text: str) -> set:
+    return {re.sub(r"\s+", "", m) for m in TOPIC_TERMS.findall(text.lower())}
+
+def stays_on_topic(question: str, qvec, anchor_query: str, anchor_qvec) -> bool:
+    if topic_terms(question) - topic_terms(anchor_query):
+        return False
+    return rag_answer.cosine(qvec, anchor_qvec) >= REUSE_SIMILARITY
+
+def drift(anchor_qvec, qvec):
+    # move the anchor toward the conversation so later turns aren't always
+    # judged against the very first question
+    mixed = [(1 - ANCHOR_DRIFT) * a + ANCHOR_DRIFT * b for a, b in zip(anchor_qvec, qvec)]
+    norm = sum(x * x for x in mixed) ** 0.5 or 1.0
+    return [x / norm for x in mixed]
+
+def retrieve_for_turn(session: Session, question: str, history):
+    """
+    Returns (query_for_answer, rows, reused).
+    With an anchor from an earlier turn, the follow-up is embedded on its own
+    and compared with the anchor; if it stays on-topic (close enough, and no
+    form or program the anchor didn't mention) the anchored chunks are reused
+    as-is: one embedding, no condense call, no DB search. Otherwise the
+    follow-up is condensed with the history and searched fresh.
+    """
+    anchor_query, anchor_qvec, anchor_rows = session.anchor()
+
+    if anchor_rows and anchor_qvec is not None:
+        qvec = rag_answer.embed_query(question)
+        if stays_on_topic(question, qvec, anchor_query, anchor_qvec):
+            # history carries the context, so the raw follow-up is enough
+            session.set_anchor(anchor_query, drift(anchor_qvec, qvec), anchor_rows)
+            return question, anchor_rows, True
+
+    standalone = rag_answer.condense_question(question, history) if history else question
+    qvec = rag_answer.embed_query(standalone)
+    rows = rag_answer.search(standalone, qvec)
+    session.set_anchor(standalone, qvec, rows)
+    return standalone, rows, False